@@ -0,0 +1,9 @@
+import multiprocessing
+import os
+
+# 生产环境启动: gunicorn -c gunicorn_conf.py main:app
+bind = os.getenv("BIND", "0.0.0.0:8000")
+# 单进程时一次阻塞调用会卡住所有并发请求，按 CPU 核数起多个 worker
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# loop / http 默认为 auto，装了 uvloop 和 httptools 会自动使用
+worker_class = "uvicorn_worker.UvicornWorker"
@@ -1,96 +1,258 @@
 import os
+import re
 import json
-import base64
-from typing import TypedDict, List, Dict, Any
+import asyncio
+import io
+import hashlib
+import time
+from contextlib import AsyncExitStack
+from dataclasses import dataclass, field
+from operator import add
+from typing import Annotated, List, Dict, Any, Optional
 from dotenv import load_dotenv
 
 from langgraph.graph import StateGraph, END
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_community.tools.tavily_search import TavilySearchResults
+from langchain_community.utilities.tavily_search import TavilySearchAPIWrapper, TAVILY_API_URL
 from fastapi import FastAPI, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
 import edge_tts
+import redis.asyncio as redis
+import httpx
+import aioboto3
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
 load_dotenv()
 
 # --- 1. 定义状态 ---
-class AgentState(TypedDict):
-    query: str
-    raw_search_results: List[Dict] # 存储原始搜索结果用于匹配 URL
-    news_data: List[str]
-    logs: List[str]
-    final_report: str
-    audio_b64: str
+# slots dataclass：字段访问走固定槽位而不是 dict 查找，节点仍然返回部分 dict
+@dataclass(slots=True)
+class AgentState:
+    query: str = ""
+    raw_search_results: List[Dict] = field(default_factory=list) # 存储原始搜索结果用于匹配 URL
+    news_data: List[str] = field(default_factory=list)
+    logs: Annotated[List[str], add] = field(default_factory=list) # 节点只返回新增日志，由 LangGraph 拼接
+    final_report: str = ""
+    audio_url: str = ""
 
 # --- 2. 初始化 ---
-# 推荐使用 DeepSeek V3 (逻辑强且便宜) 或 GPT-4o
-llm = ChatOpenAI(
-    model="deepseek-chat", 
-    api_key=os.getenv("DEEPSEEK_API_KEY"),
-    base_url="https://api.deepseek.com",
-    temperature=0.1 # 低温度保证引用准确
-)
+# LLM 和 Tavily 共用一个连接池：省掉每次调用的 TLS 握手，并发请求可走 HTTP/2 多路复用
+# 连接池绑定事件循环，和 redis_client 一样在 startup 中创建，llm 依赖它所以一起创建
+shared_client = None
+llm = None
+
+def build_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=128, max_keepalive_connections=64),
+        timeout=30
+    )
+
+def build_llm(http_async_client: httpx.AsyncClient) -> ChatOpenAI:
+    # 推荐使用 DeepSeek V3 (逻辑强且便宜) 或 GPT-4o
+    return ChatOpenAI(
+        model="deepseek-chat", 
+        api_key=os.getenv("DEEPSEEK_API_KEY"),
+        base_url="https://api.deepseek.com",
+        temperature=0.1, # 低温度保证引用准确
+        http_async_client=http_async_client
+    )
+
+class PooledTavilySearchAPIWrapper(TavilySearchAPIWrapper):
+    """Tavily 异步调用改走 shared_client (默认实现每次新建一个 aiohttp 会话)"""
+    async def raw_results_async(
+        self,
+        query: str,
+        max_results: Optional[int] = 5,
+        search_depth: Optional[str] = "advanced",
+        include_domains: Optional[List[str]] = [],
+        exclude_domains: Optional[List[str]] = [],
+        include_answer: Optional[bool] = False,
+        include_raw_content: Optional[bool] = False,
+        include_images: Optional[bool] = False,
+    ) -> Dict:
+        params = {
+            "api_key": self.tavily_api_key.get_secret_value(),
+            "query": query,
+            "max_results": max_results,
+            "search_depth": search_depth,
+            "include_domains": include_domains,
+            "exclude_domains": exclude_domains,
+            "include_answer": include_answer,
+            "include_raw_content": include_raw_content,
+            "include_images": include_images,
+        }
+        res = await shared_client.post(f"{TAVILY_API_URL}/search", json=params)
+        res.raise_for_status()
+        return res.json()
 
 # 增加搜索数量，Tavily 一次最多 5-10 条，我们可能需要多次调用
-search_tool = TavilySearchResults(max_results=5) 
+search_tool = TavilySearchResults(max_results=5, api_wrapper=PooledTavilySearchAPIWrapper())
+
+# Redis 读穿缓存：同一查询短时间内重复请求直接命中，省掉网络往返
+# 连接池绑定事件循环，在 startup 中按 worker 创建
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+redis_client = None
+SEARCH_CACHE_TTL = 600 # 10 分钟内宏观数据基本不变
+LLM_CACHE_TTL = 3600 # 同一份数据源 + 模型，研报结论不变
+TTS_CACHE_TTL = 86400 # 语音由 (文本, 音色) 唯一确定
+
+# 缓存只是加速：Redis 慢或不可达时快速失败，并在一段时间内不再尝试
+REDIS_TIMEOUT = 0.2
+REDIS_RETRY_AFTER = 30
+redis_down_until = 0.0
+
+def cache_available() -> bool:
+    return redis_client is not None and time.monotonic() >= redis_down_until
+
+def cache_failed(e: Exception):
+    global redis_down_until
+    redis_down_until = time.monotonic() + REDIS_RETRY_AFTER
+    print(f"Cache error: {e} (暂停使用缓存 {REDIS_RETRY_AFTER}s)")
+
+async def cache_get(key: str):
+    if not cache_available():
+        return None
+    try:
+        return await redis_client.get(key)
+    except Exception as e:
+        cache_failed(e)
+        return None
+
+async def cache_set(key: str, value: str, ttl: int):
+    if not cache_available():
+        return
+    try:
+        await redis_client.set(key, value, ex=ttl)
+    except Exception as e:
+        cache_failed(e)
+
+# 音频上传到 S3 / MinIO，接口只返回预签名 URL，不再把 base64 塞进 JSON
+S3_BUCKET = os.getenv("S3_BUCKET", "alpha-reports")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") # MinIO 等自建存储时配置
+PRESIGN_TTL = 3600
+s3_session = aioboto3.Session()
+s3_client = None # 同 redis_client，在 startup 中创建
+
+# Tavily 全进程并发上限，按账号速率限制配置；只针对 Tavily 本身，不限制单个图内的并发
+TAVILY_MAX_CONCURRENCY = int(os.getenv("TAVILY_MAX_CONCURRENCY", "32"))
+search_semaphore = asyncio.Semaphore(TAVILY_MAX_CONCURRENCY)
+
+def is_transient(e: BaseException) -> bool:
+    """只有超时、连接错误、429 和 5xx 值得重试；401 等重试也不会成功"""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
+async def search_with_retry(q: str) -> List[Dict]:
+    # 直接调用 api_wrapper：TavilySearchResults 会把异常吞成错误字符串，无法区分错误类型
+    wrapper = search_tool.api_wrapper
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential_jitter(initial=0.5, max=4),
+        retry=retry_if_exception(is_transient),
+        reraise=True
+    ):
+        with attempt:
+            async with search_semaphore:
+                raw = await wrapper.raw_results_async(q, search_tool.max_results, search_tool.search_depth)
+            return wrapper.clean_results(raw["results"])
+
+async def _search_and_cache(q: str, key: str) -> List[Dict]:
+    results = await search_with_retry(q)
+    await cache_set(key, json.dumps(results), SEARCH_CACHE_TTL)
+    return results
+
+# 进行中的搜索：同一查询同时只发一次请求，其余并发调用等待同一个结果
+inflight_searches: Dict[str, asyncio.Task] = {}
+
+async def cached_search(q: str):
+    """带缓存的 Tavily 搜索 (Redis 不可用时直接走网络)"""
+    key = f"tav:{hashlib.sha1(q.encode()).hexdigest()}"
+    cached = await cache_get(key)
+    if cached:
+        return json.loads(cached)
+    task = inflight_searches.get(key)
+    if task is None:
+        task = asyncio.create_task(_search_and_cache(q, key))
+        inflight_searches[key] = task
+        task.add_done_callback(lambda _: inflight_searches.pop(key, None))
+    # shield：某个请求被取消时不影响其他等待同一结果的请求
+    return await asyncio.shield(task)
 
 # --- 3. 节点定义 ---
 
-def search_node(state: AgentState):
+# 每个数据源喂给 LLM 的最大字符数，控制 prompt token 数
+MAX_SOURCE_CHARS = 800
+
+# 定义多个维度的搜索词，确保覆盖面达到 10 个源 (模块级常量，不必每次请求重建)
+MACRO_SEARCH_QUERIES = (
+    "latest US GDP CPI inflation Fed interest rate data official",
+    "China GDP PMI manufacturing exports imports data current month",
+    "Global commodities gold oil bitcoin price trends today",
+    "Major central banks policy rates and bond yields 10y"
+)
+
+async def search_node(state: AgentState):
     """宏观数据搜集员 (搜索 10+ 个源)"""
-    logs = state.get("logs", [])
-    logs.append("🌍 [Macro Scout] 正在启动全网宏观数据扫描...")
+    logs = ["🌍 [Macro Scout] 正在启动全网宏观数据扫描..."]
     
-    # 定义两个维度的搜索词，确保覆盖面达到 10 个源
-    search_queries = [
-        "latest US GDP CPI inflation Fed interest rate data official",
-        "China GDP PMI manufacturing exports imports data current month",
-        "Global commodities gold oil bitcoin price trends today",
-        "Major central banks policy rates and bond yields 10y"
-    ]
+    # 通用宏观维度在不同 topic 间共享 (命中缓存)，再加一个围绕 topic 本身的维度
+    search_queries = MACRO_SEARCH_QUERIES + (f"{state.query} latest economic data and market news",)
+    
+    # 各维度互不依赖，并发搜索，耗时取最慢的一次而不是总和
+    for q in search_queries:
+        logs.append(f"🔍 搜索维度: {q}...")
+    results_lists = await asyncio.gather(
+        *[cached_search(q) for q in search_queries], return_exceptions=True
+    )
     
     all_results = []
     seen_urls = set()
+    seen_sigs = set() # 内容指纹：不同 URL 转载的同一篇稿子只保留一份
     
-    for q in search_queries:
+    for results in results_lists:
+        if isinstance(results, Exception):
+            print(f"Search error: {results}")
+            continue
         try:
-            logs.append(f"🔍 搜索维度: {q}...")
-            results = search_tool.invoke(q)
-            
             for res in results:
-                if res['url'] not in seen_urls:
-                    seen_urls.add(res['url'])
-                    # 给每个内容打上 ID，方便 LLM 引用
-                    all_results.append({
-                        "id": len(all_results) + 1,
-                        "url": res['url'],
-                        "content": res['content'],
-                        "title": res['url'] # 简化标题
-                    })
+                if res['url'] in seen_urls:
+                    continue
+                seen_urls.add(res['url'])
+                sig = hashlib.blake2b(res['content'][:256].encode(), digest_size=8).digest()
+                if sig in seen_sigs:
+                    continue
+                seen_sigs.add(sig)
+                # 给每个内容打上 ID，方便 LLM 引用
+                all_results.append({
+                    "id": len(all_results) + 1,
+                    "url": res['url'],
+                    "content": res['content'][:MAX_SOURCE_CHARS],
+                    "title": res['url'] # 简化标题
+                })
         except Exception as e:
             print(f"Search error: {e}")
             
     logs.append(f"✅ [Macro Scout] 共采集到 {len(all_results)} 个独立宏观数据源。")
     
-    # 将结果格式化为文本喂给 LLM
-    context_text = ""
-    for item in all_results:
-        context_text += f"Source_ID [{item['id']}] (URL: {item['url']}): {item['content']}\n\n"
+    # 将结果格式化为文本喂给 LLM (一次 join，避免字符串反复拼接)
+    context_text = "".join(
+        f"Source_ID [{item['id']}] (URL: {item['url']}): {item['content']}\n\n" for item in all_results
+    )
         
     return {"raw_search_results": all_results, "news_data": [context_text], "logs": logs}
 
-def analyst_node(state: AgentState):
-    """首席宏观分析师 (严格格式控制)"""
-    logs = state.get("logs", [])
-    logs.append("🧠 [Chief Analyst] 正在进行数据交叉验证与合成计算...")
-    
-    context = state['news_data'][0]
-    
-    # 核心 Prompt：强制要求数字链接和公式展示
-    prompt = ChatPromptTemplate.from_template("""
-    你是一位华尔街顶级宏观对冲基金的首席策略师。请基于提供的【数据源列表】，撰写一份《全球宏观深度研报》。
+# 核心 Prompt：强制要求数字链接和公式展示 (模块级构建一次，避免每次请求重新解析模板)
+analyst_prompt = ChatPromptTemplate.from_template("""
+    你是一位华尔街顶级宏观对冲基金的首席策略师。请围绕【研报主题】，基于提供的【数据源列表】，撰写一份《全球宏观深度研报》。
+
+    【研报主题】: {topic}
 
     【严格约束】
     1. **引用即链接**：报告中出现的所有核心数据（如 GDP、CPI、利率、价格），必须做成 Markdown 链接格式，指向原始 URL。
@@ -114,31 +276,74 @@ def analyst_node(state: AgentState):
     【数据源列表】:
     {context}
     """)
+analyst_chain = None # analyst_prompt | llm，在 startup 中创建 llm 后组装
+
+async def analyst_node(state: AgentState):
+    """首席宏观分析师 (严格格式控制)"""
+    logs = ["🧠 [Chief Analyst] 正在进行数据交叉验证与合成计算..."]
     
-    chain = prompt | llm
-    response = chain.invoke({"context": context})
+    context = state.news_data[0]
+    
+    # 完整 prompt (模板 + 主题 + 数据源) 和模型都没变，就直接复用上一次的研报；改模板后自动失效
+    inputs = {"context": context, "topic": state.query}
+    prompt_text = analyst_prompt.format(**inputs)
+    digest = hashlib.sha256(f"{llm.model_name}\0{prompt_text}".encode()).hexdigest()
+    key = f"llm:{digest}"
+    cached = await cache_get(key)
+    if cached:
+        logs.append("🚀 [System] 数据源未变化，复用已生成的深度研报。")
+        return {"final_report": cached, "logs": logs}
+    
+    # 流式生成：token 会经由图的 messages 流实时推给前端
+    parts = []
+    async for chunk in analyst_chain.astream(inputs):
+        parts.append(chunk.content)
+    report = "".join(parts)
+    await cache_set(key, report, LLM_CACHE_TTL)
     
     logs.append("🚀 [System] 深度研报构建完成。")
-    return {"final_report": response.content, "logs": logs}
+    return {"final_report": report, "logs": logs}
+
+# Markdown 链接 [数值](URL) 只保留数值；剩余的括号 (如公式注释) 直接去掉
+_MD_LINK = re.compile(r'\[([^\]]+)\]\([^)]+\)')
+_MD_STRIP = re.compile(r'[\[\]\(\)]')
+
+async def synthesize(text: str, voice: str) -> str:
+    """Edge TTS 合成并上传，返回预签名 URL (按文本 + 音色缓存)"""
+    h = hashlib.sha256(f"{voice}\0{text}".encode()).hexdigest()
+    key = f"tts:{h}"
+    object_key = f"tts/{h}.mp3" # 与缓存同键，命中时无需重新上传
+    
+    if not await cache_get(key):
+        communicate = edge_tts.Communicate(text, voice)
+        audio_data = bytearray() # 原地扩展，避免 bytes 拼接反复拷贝
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                audio_data.extend(chunk["data"])
+        if not audio_data:
+            return ""
+        await s3_client.upload_fileobj(
+            io.BytesIO(audio_data), S3_BUCKET, object_key, ExtraArgs={"ContentType": "audio/mpeg"}
+        )
+        await cache_set(key, object_key, TTS_CACHE_TTL)
+    
+    return await s3_client.generate_presigned_url(
+        "get_object", Params={"Bucket": S3_BUCKET, "Key": object_key}, ExpiresIn=PRESIGN_TTL
+    )
 
 async def speech_node(state: AgentState):
     """语音合成 (仅朗读摘要，避免读 URL)"""
-    logs = state.get("logs", [])
-    # 简单截取前 500 字做语音，防止朗读 URL 体验不好
-    text_to_read = state['final_report'][:500].replace("[", "").replace("]", "").replace("(", "").replace(")", "")
+    # 先去掉链接里的 URL 再截取前 500 字，避免截断半个链接后把 URL 读出来
+    text_to_read = _MD_STRIP.sub('', _MD_LINK.sub(r'\1', state.final_report)[:500])
     
-    audio_b64 = ""
+    audio_url = ""
     try:
-        communicate = edge_tts.Communicate(text_to_read, "zh-CN-YunxiNeural")
-        audio_data = b""
-        async for chunk in communicate.stream():
-            if chunk["type"] == "audio":
-                audio_data += chunk["data"]
-        audio_b64 = base64.b64encode(audio_data).decode('utf-8')
-    except:
-        pass
+        audio_url = await synthesize(text_to_read, "zh-CN-YunxiNeural")
+    except Exception as e:
+        # 包括 S3 未配置 / bucket 不存在 / 凭证错误：音频依赖对象存储
+        print(f"TTS error: {e}")
     
-    return {"audio_b64": audio_b64}
+    return {"audio_url": audio_url}
 
 # --- 4. 构建图 ---
 workflow = StateGraph(AgentState)
@@ -151,21 +356,108 @@ workflow.add_edge("macro_scout", "chief_analyst")
 workflow.add_edge("chief_analyst", "speech_synthesizer")
 workflow.add_edge("speech_synthesizer", END)
 
-app_graph = workflow.compile()
-
 # --- 5. API ---
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+# JSON 响应 (研报正文、批量结果) 压缩收益明显；SSE (text/event-stream) 不会被压缩，保证逐条推送
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+@app.on_event("startup")
+async def startup():
+    global redis_client, s3_client, shared_client, llm, analyst_chain
+    shared_client = build_http_client()
+    llm = build_llm(shared_client)
+    analyst_chain = analyst_prompt | llm
+    redis_client = redis.from_url(
+        REDIS_URL, decode_responses=True,
+        socket_connect_timeout=REDIS_TIMEOUT, socket_timeout=REDIS_TIMEOUT
+    )
+    app.state.exit_stack = AsyncExitStack()
+    s3_client = await app.state.exit_stack.enter_async_context(
+        s3_session.client("s3", endpoint_url=S3_ENDPOINT_URL)
+    )
+    # 每个 worker 启动时编译一次图
+    app.state.graph = workflow.compile()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await redis_client.aclose()
+    await shared_client.aclose()
+    await app.state.exit_stack.aclose()
 
 class ReportRequest(BaseModel):
     topic: str = "Macro"
 
+class BatchRequest(BaseModel):
+    topics: List[str]
+
+# 批量接口的并发上限，避免打爆 LLM / Tavily 的速率限制
+batch_semaphore = asyncio.Semaphore(16)
+
+def sse(payload: Dict[str, Any]) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+async def event_gen(req: ReportRequest):
+    """按节点推送 SSE 事件：log -> token -> report -> audio -> done (失败时以 error 结束)"""
+    inputs = {"query": req.topic}
+    try:
+        async for mode, chunk in app.state.graph.astream(inputs, stream_mode=["updates", "messages"]):
+            if mode == "messages":
+                message, metadata = chunk
+                if metadata.get("langgraph_node") == "chief_analyst" and message.content:
+                    yield sse({"type": "token", "content": message.content})
+                continue
+            
+            for node, update in chunk.items():
+                # updates 里的 logs 就是该节点新增的日志
+                for line in update.get("logs", []):
+                    yield sse({"type": "log", "content": line})
+                
+                if "final_report" in update:
+                    yield sse({"type": "report", "report": update["final_report"]})
+                if "audio_url" in update:
+                    yield sse({"type": "audio", "audio_url": update["audio_url"]})
+    except Exception as e:
+        # 响应头已经发出 (200)，只能通过事件告诉前端失败了
+        print(f"Graph error: {e}")
+        yield sse({"type": "error", "message": str(e)})
+        return
+    
+    yield sse({"type": "done"})
+
 @app.post("/generate_report")
 async def generate_report(req: ReportRequest):
-    inputs = {"query": req.topic, "logs": []}
-    result = await app_graph.ainvoke(inputs)
+    return StreamingResponse(
+        event_gen(req),
+        media_type="text/event-stream",
+        # 禁止代理 (如 nginx) 缓冲和缓存，保证事件逐条到达
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def run_report(topic: str) -> Dict[str, Any]:
+    async with batch_semaphore:
+        result = await app.state.graph.ainvoke({"query": topic})
     return {
+        "topic": topic,
         "report": result["final_report"],
         "logs": result["logs"],
-        "audio": result["audio_b64"]
-    }
\ No newline at end of file
+        "audio_url": result["audio_url"]
+    }
+
+@app.post("/generate_reports")
+async def generate_reports(req: BatchRequest):
+    """批量生成：多个 topic 共用一次 HTTP 往返，图并发执行 (重复的 topic 只跑一次)"""
+    topics = list(dict.fromkeys(req.topics))
+    results = await asyncio.gather(*(run_report(t) for t in topics), return_exceptions=True)
+    # 单个 topic 失败不影响其他 topic 的结果
+    return [
+        {"topic": t, "error": str(r)} if isinstance(r, Exception) else r
+        for t, r in zip(topics, results)
+    ]
+
+if __name__ == "__main__":
+    # 本地调试用；生产环境多 worker 启动见 gunicorn_conf.py
+    import uvicorn
+    # 该服务以 socket I/O 和等待 LLM / Tavily 为主，事件循环开销直接体现在延迟上
+    # loop="auto"：装了 uvloop 就用 uvloop (Windows 上没有，回退到标准 asyncio)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto", http="httptools")